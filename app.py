@@ -5,24 +5,40 @@ import io
 import time
 import warnings
 from datetime import datetime
-from collections import deque
+from math import copysign, fabs
+from concurrent.futures import ThreadPoolExecutor
 import plotly.express as px
 import plotly.graph_objects as go
 
+# 容差常量、数值与取列工具、numba 降级封装与 FIFO 净仓内核与 hedge_engine 共用，只在引擎中定义一次
+from hedge_engine import (
+    EPS, MIN_ALLOC, column_values, downcast_float, factorize_groups, fifo_net_kernel, njit,
+)
+
 warnings.filterwarnings("ignore", category=UserWarning)
 
 # ---------------------------------------------------------
 # 1. 基础工具 (Utils)
 # ---------------------------------------------------------
 
+_MONTH_SEPARATORS = str.maketrans('-/', '  ')
+
 def clean_str(series):
     """清洗字符串：去除前后空格，转大写，替换 'NAN' 为''。"""
-    return series.astype(str).str.strip().str.upper().replace('NAN', '')
+    # 去空格与转大写合并为一次遍历
+    cleaned = pd.Series(
+        [str(x).strip().upper() for x in series.to_numpy()],
+        index=series.index, name=series.name, dtype=object,
+    )
+    return cleaned.replace('NAN', '')
 
 def standardize_month_vectorized(series):
     """将字符串月份标准化为统一的 `MON YY` 格式（例如 'JAN 24'）。"""
-    s = series.astype(str).str.strip().str.upper()
-    s = s.str.replace('-', ' ', regex=False).str.replace('/', ' ', regex=False)
+    # 去空格、转大写、分隔符替换合并为一次遍历
+    s = pd.Series(
+        [str(x).strip().upper().translate(_MONTH_SEPARATORS) for x in series.to_numpy()],
+        index=series.index, name=series.name, dtype=object,
+    )
     # 首先尝试直接解析
     dates = pd.to_datetime(s, errors='coerce')
     # 提取正常解析的结果
@@ -31,29 +47,80 @@ def standardize_month_vectorized(series):
     mask_invalid = dates.isna()
     if mask_invalid.any():
         invalid = s[mask_invalid]
-        # 尝试匹配反转形式，例如 '26 APR' -> 'APR 26'
-        import re
-        def swap_if_match(val):
-            m = re.match(r'^(\d{2})\s*([A-Z]{3})$', val)
-            if m:
-                yr, mon = m.groups()
-                return f"{mon} {yr}"
-            return val
-        swapped = invalid.map(swap_if_match)
-        # 尝试再次解析
-        swapped_dates = pd.to_datetime(swapped, errors='coerce')
-        # 格式化
-        swapped_formatted = swapped_dates.dt.strftime('%b %y').str.upper()
-        # 对成功解析的部分用新值
-        result.loc[mask_invalid & swapped_dates.notna()] = swapped_formatted.loc[
-            swapped_dates.notna()
-        ]
-        # 对仍然无法解析的部分保持原样
-        result.loc[mask_invalid & swapped_dates.isna()] = swapped.loc[
-            swapped_dates.isna()
-        ]
+        # 尝试匹配反转形式，例如 '26 APR' -> 'APR 26'（整列一次 extract）
+        parts = invalid.str.extract(r'^(\d{2})\s*([A-Z]{3})$')
+        is_swapped = parts[0].notna()
+        swapped = (parts[1] + ' ' + parts[0]).fillna(invalid)
+        # 尝试再次解析：反转后的值固定为 'MON YY'，按格式解析不走逐个推断；
+        # 其余值（如与 ISO 日期混在一列的 'MAR 2026'）仍按原逻辑推断格式
+        swapped_formatted = pd.concat([
+            pd.to_datetime(swapped[is_swapped], format='%b %y', errors='coerce').dt.strftime('%b %y'),
+            pd.to_datetime(swapped[~is_swapped], errors='coerce').dt.strftime('%b %y'),
+        ]).reindex(swapped.index).str.upper()
+        # 对成功解析的部分用新值，仍然无法解析的部分保持原样
+        result.loc[mask_invalid] = swapped_formatted.fillna(swapped)
     return result
 
+def read_uploaded_file(file_obj, file_name):
+    """按扩展名读取上传文件：扩展名已能确定格式，不再嗅探文件内容。"""
+    if file_name.lower().endswith(('.xlsx', '.xls')):
+        # 优先用 calamine (Rust) 引擎，未安装或 pandas 不支持时退回默认引擎
+        try:
+            return pd.read_excel(file_obj, engine='calamine')
+        except (ImportError, ValueError):
+            file_obj.seek(0)
+            return pd.read_excel(file_obj)
+    return pd.read_csv(file_obj)
+
+def prepare_data(df_paper, df_physical):
+    """纸货、实货字段清洗与标准化，返回处理后的 (df_paper, df_physical)。"""
+    # 纸货数据预处理
+    if 'Trade Date' in df_paper.columns:
+        df_paper['Trade Date'] = pd.to_datetime(df_paper['Trade Date'])
+    if 'Volume' in df_paper.columns:
+        df_paper['Volume'] = downcast_float(pd.to_numeric(df_paper['Volume'], errors='coerce').fillna(0))
+    if 'Commodity' in df_paper.columns:
+        df_paper['Std_Commodity'] = clean_str(df_paper['Commodity'])
+    if 'Month' in df_paper.columns:
+        df_paper['Month'] = standardize_month_vectorized(df_paper['Month'])
+    if 'Recap No' not in df_paper.columns:
+        df_paper['Recap No'] = df_paper.index.astype(str)
+    
+    # 实货数据预处理
+    col_map = {'Target_Pricing_Month': 'Target_Contract_Month', 'Month': 'Target_Contract_Month'}
+    df_physical = df_physical.rename(columns=col_map)
+    if 'Volume' in df_physical.columns:
+        df_physical['Volume'] = downcast_float(pd.to_numeric(df_physical['Volume'], errors='coerce').fillna(0))
+        # 未对冲量在匹配中逐船回写剩余值，保持 float64
+        df_physical['Unhedged_Volume'] = df_physical['Volume'].astype(np.float64)
+    if 'Hedge_Proxy' in df_physical.columns:
+        df_physical['Hedge_Proxy'] = clean_str(df_physical['Hedge_Proxy'])
+    if 'Target_Contract_Month' in df_physical.columns:
+        df_physical['Target_Contract_Month'] = standardize_month_vectorized(df_physical['Target_Contract_Month'])
+    
+    # 指定日期处理
+    if 'Designation_Date' in df_physical.columns:
+        df_physical['Designation_Date'] = pd.to_datetime(df_physical['Designation_Date'], errors='coerce')
+    elif 'Pricing_Start' in df_physical.columns:
+        df_physical['Designation_Date'] = pd.to_datetime(df_physical['Pricing_Start'], errors='coerce')
+    else:
+        df_physical['Designation_Date'] = pd.NaT
+    return df_paper, df_physical
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_uploaded_data(paper_bytes, paper_name, physical_bytes, physical_name):
+    """按上传文件内容缓存读取与预处理结果，返回两份原始数据预览及处理后的数据。"""
+    # 两个文件互不依赖，解析主要在 C 扩展中进行，用线程并行读取
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        paper_future = executor.submit(read_uploaded_file, io.BytesIO(paper_bytes), paper_name)
+        physical_future = executor.submit(read_uploaded_file, io.BytesIO(physical_bytes), physical_name)
+        df_paper = paper_future.result()
+        df_physical = physical_future.result()
+    paper_preview = df_paper.head().copy()
+    physical_preview = df_physical.head().copy()
+    df_paper, df_physical = prepare_data(df_paper, df_physical)
+    return paper_preview, physical_preview, df_paper, df_physical
+
 # ---------------------------------------------------------
 # 2. 核心：FIFO 净仓计算引擎 (Corrected Netting Engine)
 # ---------------------------------------------------------
@@ -66,90 +133,69 @@ def calculate_net_positions_corrected(df_paper):
     
     # 按交易日期排序，确保 FIFO
     df_paper = df_paper.sort_values(by='Trade Date').reset_index(drop=True)
-    # 组合键：品种+合约月
-    df_paper['Group_Key'] = df_paper['Std_Commodity'] + "_" + df_paper['Month']
-    # 转字典记录加速
-    records = df_paper.to_dict('records')
-    groups = {}
-    # 按组合键分组交易
-    for i, row in enumerate(records):
-        key = row['Group_Key']
-        if key not in groups:
-            groups[key] = []
-        groups[key].append(i)
-        if i % 100 == 0:
-            progress_bar.progress(min(i / len(records) * 0.5, 0.5))
+    # 组合键：品种+合约月（整数组号，稳定排序后同组交易连续且保持时间顺序）
+    group_codes, group_labels = factorize_groups(df_paper)
+    df_paper['Group_Key'] = group_labels.take(group_codes).to_numpy()
+    n_rows = len(df_paper)
+    # 列式数组 (SoA)：FIFO 只需要成交量，不再逐行转字典
+    vols = df_paper['Volume'].to_numpy(dtype=np.float64)
+    order = np.argsort(group_codes, kind='stable')
+    group_bounds = np.flatnonzero(np.diff(group_codes[order])) + 1
+    group_starts = np.concatenate(([0], group_bounds, [n_rows])) if n_rows else np.zeros(1, dtype=np.int64)
+    progress_bar.progress(0.5)
     
-    st.info(f"数据分组完成，共 {len(groups)} 个组。")
+    st.info(f"数据分组完成，共 {len(group_starts) - 1} 个组。")
     
-    # 遍历每个组，进行FIFO平仓
-    group_count = 0
-    for key, indices in groups.items():
-        open_queue = deque()
-        for idx in indices:
-            row = records[idx]
-            current_vol = row.get('Volume', 0)
-            # 初始化净开仓量和已平仓量
-            records[idx]['Net_Open_Vol'] = current_vol
-            records[idx]['Closed_Vol'] = 0
-            records[idx]['Close_Events'] = []
-            if abs(current_vol) < 0.0001:
-                continue
-            current_sign = 1 if current_vol > 0 else -1
-            while open_queue:
-                q_idx, q_vol, q_sign = open_queue[0]
-                # 方向相反才能抵消
-                if q_sign != current_sign:
-                    offset = min(abs(current_vol), abs(q_vol))
-                    # 更新当前交易和队列交易的剩余量
-                    current_vol -= (current_sign * offset)
-                    q_vol -= (q_sign * offset)
-                    # 记录平仓事件到原交易
-                    close_event = {
-                        'Ref': str(records[idx].get('Recap No', '')),
-                        'Date': records[idx].get('Trade Date'),
-                        'Vol': offset,
-                        'Price': records[idx].get('Price', 0)
-                    }
-                    records[q_idx]['Close_Events'].append(close_event)
-                    records[q_idx]['Closed_Vol'] += offset
-                    records[q_idx]['Net_Open_Vol'] = q_vol
-                    records[idx]['Closed_Vol'] += offset
-                    records[idx]['Net_Open_Vol'] = current_vol
-                    if abs(q_vol) < 0.0001:
-                        open_queue.popleft()
-                    else:
-                        open_queue[0] = (q_idx, q_vol, q_sign)
-                    if abs(current_vol) < 0.0001:
-                        break
-                else:
-                    break
-            # 如果还有未抵消净额，入队
-            if abs(current_vol) > 0.0001:
-                open_queue.append((idx, current_vol, current_sign))
-        group_count += 1
-        progress_bar.progress(0.5 + (group_count / len(groups)) * 0.5)
+    net_open_vol = vols.copy()
+    closed_vol = np.zeros(n_rows)
+    # 平仓事件 (开仓行, 平仓行, 抵消量)：每次抵消至少了结一笔交易，
+    # 每组事件数不超过组内行数，因此每组直接占用与自身行位置相同的槽位
+    event_opener = np.full(n_rows, -1, dtype=np.int64)
+    event_closer = np.empty(n_rows, dtype=np.int64)
+    event_vol = np.empty(n_rows, dtype=np.float64)
+    fifo_net_kernel(vols, order.astype(np.int64), group_starts.astype(np.int64), net_open_vol, closed_vol,
+                    event_opener, event_closer, event_vol)
+    used = np.flatnonzero(event_opener >= 0)
+    
+    # 最后一次性还原每笔开仓单的平仓事件列表：事件整体按平仓日期稳定排序一次
+    # （空日期排最前），每个开仓单的列表天然有序，展示时不必再逐单排序
+    refs = df_paper['Recap No'].astype(str).to_numpy() if 'Recap No' in df_paper.columns else np.full(n_rows, '')
+    dates = df_paper['Trade Date'].array
+    prices = df_paper['Price'].to_numpy() if 'Price' in df_paper.columns else np.zeros(n_rows)
+    date_keys = df_paper['Trade Date'].to_numpy('datetime64[ns]').view('int64')
+    used = used[np.argsort(date_keys[event_closer[used]], kind='stable')]
+    close_events = [[] for _ in range(n_rows)]
+    for opener, closer, offset in zip(event_opener[used], event_closer[used], event_vol[used]):
+        close_events[opener].append({
+            'Ref': refs[closer],
+            'Date': dates[closer],
+            'Vol': offset,
+            'Price': prices[closer]
+        })
     
     elapsed = time.time() - start_time
     progress_bar.progress(1.0)
     st.success(f"纸货内部对冲完成，耗时 {round(elapsed, 2)} 秒。")
-    return pd.DataFrame(records)
+    return df_paper.assign(Net_Open_Vol=net_open_vol, Closed_Vol=closed_vol, Close_Events=close_events)
 
 # ---------------------------------------------------------
 # 3. 匹配逻辑 (v19 开放式时间排序)
 # ---------------------------------------------------------
 
-def format_close_details(events):
-    """整理平仓路径：返回字符串描述、加权平仓价格、平仓量。"""
+def format_close_details(events, date_strs=None):
+    """整理平仓路径：返回字符串描述、加权平仓价格、平仓量。
+
+    date_strs 可传入与 events 一一对应、已批量格式化的日期字符串。
+    """
     if not events:
         return "", 0, 0
+    if date_strs is None:
+        date_strs = [e['Date'].strftime('%Y-%m-%d') if pd.notna(e['Date']) else 'N/A' for e in events]
     details = []
     total_vol = 0
     total_val = 0
-    # 按日期排序平仓事件
-    sorted_events = sorted(events, key=lambda x: x['Date'] if pd.notna(x['Date']) else pd.Timestamp.min)
-    for e in sorted_events:
-        d_str = e['Date'].strftime('%Y-%m-%d') if pd.notna(e['Date']) else 'N/A'
+    # 平仓事件已由净仓引擎按日期排好序
+    for e, d_str in zip(events, date_strs):
         p_str = f"@{e['Price']}" if pd.notna(e['Price']) else ""
         details.append(f"[{d_str} Tkt#{e['Ref']} Vol:{e['Vol']:.0f} {p_str}]")
         if pd.notna(e['Price']):
@@ -179,164 +225,292 @@ def _contract_month_priority(month_value):
     priority = priority_order.index(key) if key in priority_order else 999
     return priority, parsed
 
+@njit(cache=True)
+def _allocate_kernel(cargo_vols, cand_ptr, cand_flat, paper_vol, paper_allocated,
+                     rel_cargo, rel_slot, rel_alloc):
+    """按实货顺序依次把剩余量分给已排好序的候选纸货单，返回分配条数。"""
+    n_rel = 0
+    for c in range(len(cand_ptr) - 1):
+        phy_vol = cargo_vols[c]
+        for k in range(cand_ptr[c], cand_ptr[c + 1]):
+            need_abs = fabs(phy_vol)
+            if need_abs < MIN_ALLOC:
+                break
+            pos = cand_flat[k]
+            avail = paper_vol[pos] - paper_allocated[pos]
+            avail_abs = fabs(avail)
+            if avail_abs < EPS:
+                continue
+            alloc_abs = need_abs if avail_abs >= need_abs else avail_abs
+            alloc = copysign(alloc_abs, avail)
+            phy_vol -= alloc_abs
+            paper_allocated[pos] += alloc
+            rel_cargo[n_rel] = c
+            rel_slot[n_rel] = k
+            rel_alloc[n_rel] = alloc
+            n_rel += 1
+        cargo_vols[c] = phy_vol
+    return n_rel
+
 def auto_match_hedges(physical_df, paper_df):
     """实货匹配逻辑"""
-    hedge_relations = []
     st.info("开始实货匹配...")
     progress_bar = st.progress(0)
 
     match_start = _match_start_date(paper_df)
-    active_paper = paper_df[paper_df['Trade Date'] >= match_start].copy()
-    active_paper['Allocated_To_Phy'] = 0.0
-    active_paper['_original_index'] = active_paper.index
-    
-    df_phy = physical_df.copy()
-    df_phy['_orig_idx'] = df_phy.index
+    active_mask = (paper_df['Trade Date'] >= match_start).to_numpy()
+    active_paper = paper_df[active_mask]
     
     # 根据定价基准优先级对实货排序：BRENT 优先匹配，JCC 次之
-    if 'Pricing_Benchmark' in df_phy.columns:
+    # 排序键单独建小表，只对实货表做一次按位置取行，避免整表 copy
+    if 'Pricing_Benchmark' in physical_df.columns:
         def bench_prio(x):
             x_str = str(x).upper()
             return 0 if 'BRENT' in x_str else (1 if 'JCC' in x_str else 2)
-        df_phy['_priority'] = df_phy['Pricing_Benchmark'].apply(bench_prio)
-        contract_priority = df_phy['Target_Contract_Month'].apply(_contract_month_priority)
-        df_phy['_contract_priority'] = contract_priority.map(lambda x: x[0])
-        df_phy['_contract_date'] = contract_priority.map(lambda x: x[1])
-        df_phy = df_phy.sort_values(
+        contract_priority = physical_df['Target_Contract_Month'].apply(_contract_month_priority)
+        sort_keys = pd.DataFrame({
+            '_priority': physical_df['Pricing_Benchmark'].apply(bench_prio).to_numpy(),
+            '_contract_priority': contract_priority.map(lambda x: x[0]).to_numpy(),
+            '_contract_date': contract_priority.map(lambda x: x[1]).to_numpy(),
+            '_orig_idx': physical_df.index,
+        })
+        phy_order = sort_keys.sort_values(
             by=['_priority', '_contract_priority', '_contract_date', '_orig_idx']
-        ).reset_index(drop=True)
-        df_phy = df_phy.drop(columns=['_priority', '_contract_priority', '_contract_date'])
+        ).index.to_numpy()
     else:
-        df_phy = df_phy.reset_index(drop=True)
+        phy_order = np.arange(len(physical_df))
+    df_phy = physical_df.take(phy_order)
+    
+    # 分配量和未对冲量放在按位置索引的数组里累加，循环结束后一次性写回
+    paper_vol = active_paper['Volume'].to_numpy(dtype=np.float64)
+    paper_allocated = np.zeros(len(active_paper))
+    phy_unhedged = (
+        df_phy['Unhedged_Volume'].to_numpy(dtype=np.float64, copy=True)
+        if 'Unhedged_Volume' in df_phy.columns else None
+    )
+    # (品种, 合约月) → 行位置的哈希索引，循环外只建一次；
+    # 代理品种按子串匹配，每个代理只扫描一次去重后的品种列表；
+    # 同一 (代理, 合约月) 的候选位置只合并排序一次，之后的船直接查表
+    bucket_positions = active_paper.groupby(['Std_Commodity', 'Month'], sort=False).indices
+    paper_commodities = active_paper['Std_Commodity'].unique()
+    proxy_commodities = {}
+    proxy_month_positions = {}
+    
+    # 实货与纸货字段循环外整列取出，循环内按位置取值，不再逐行构造 Series
+    cargo_ids = column_values(df_phy, 'Cargo_ID', None)
+    proxies = column_values(df_phy, 'Hedge_Proxy', '')
+    target_months = column_values(df_phy, 'Target_Contract_Month', None)
+    desig_dates = (
+        df_phy['Designation_Date'].array
+        if 'Designation_Date' in df_phy.columns else [pd.NaT] * len(df_phy)
+    )
+    paper_price = column_values(active_paper, 'Price', 0).astype(np.float64)
+    paper_mtm = column_values(active_paper, 'Mtm Price', 0).astype(np.float64)
+    paper_total_pl = column_values(active_paper, 'Total P/L', 0).astype(np.float64)
+    paper_close_events = column_values(active_paper, 'Close_Events', None)
+    paper_volume = column_values(active_paper, 'Volume', 0)
+    paper_trade_date = column_values(active_paper, 'Trade Date', None)
+    paper_ticket_id = column_values(active_paper, 'Recap No', None)
+    paper_month = column_values(active_paper, 'Month', None)
+    paper_net_open = column_values(active_paper, 'Net_Open_Vol', 0)
+    paper_closed = column_values(active_paper, 'Closed_Vol', 0)
+    # 交易日期转成 int64 纳秒，时间差与排序都在整数数组上完成
+    # （active_paper 已按开始日期过滤，不含空日期）
+    paper_date_ns = active_paper['Trade Date'].to_numpy('datetime64[ns]').view('int64')
     
+    # 第一遍：逐船确定候选纸货单及其顺序。候选只取决于实货自身字段，
+    # 与其他船的分配结果无关，按 CSR（偏移 + 扁平数组）拼接后交给分配内核
     total_cargos = len(df_phy)
-    for idx, (_, cargo) in enumerate(df_phy.iterrows()):
-        cargo_id = cargo.get('Cargo_ID')
-        phy_vol = cargo.get('Unhedged_Volume', 0)
-        if abs(phy_vol) < 0.0001:
+    cargo_vols = phy_unhedged if phy_unhedged is not None else np.zeros(total_cargos)
+    cand_counts = np.zeros(total_cargos, dtype=np.int64)
+    cand_chunks = []
+    lag_chunks = []
+    for idx in range(total_cargos):
+        # 剩余量不足最小分配量时分配会立即退出，直接跳过，不再取候选
+        if abs(cargo_vols[idx]) < MIN_ALLOC:
             continue
             
-        proxy = str(cargo.get('Hedge_Proxy', ''))
-        target_month = cargo.get('Target_Contract_Month', None)
-        phy_dir = cargo.get('Direction', 'Buy')
-        desig_date = cargo.get('Designation_Date', pd.NaT)
+        proxy = str(proxies[idx])
+        target_month = target_months[idx]
+        desig_date = desig_dates[idx]
         
         # 基础筛选: 品种、合约月
-        candidates_df = active_paper[
-            (active_paper['Std_Commodity'].str.contains(proxy, regex=False)) &
-            (active_paper['Month'] == target_month)
-        ].copy()
-        
-        if candidates_df.empty:
+        cand_positions = proxy_month_positions.get((proxy, target_month))
+        if cand_positions is None:
+            if proxy not in proxy_commodities:
+                proxy_commodities[proxy] = [c for c in paper_commodities if proxy in c]
+            bucket_hits = [
+                bucket_positions[(commodity, target_month)]
+                for commodity in proxy_commodities[proxy]
+                if (commodity, target_month) in bucket_positions
+            ]
+            cand_positions = (
+                np.sort(np.concatenate(bucket_hits)) if bucket_hits else np.zeros(0, dtype=np.int64)
+            )
+            proxy_month_positions[(proxy, target_month)] = cand_positions
+        if not len(cand_positions):
             continue
+        cand_dates = paper_date_ns[cand_positions]
             
-        # 如果有指定日期, 计算时间差绝对值
-        if pd.notna(desig_date) and not candidates_df['Trade Date'].isnull().all():
-            candidates_df['Time_Lag_Days'] = (candidates_df['Trade Date'] - desig_date).dt.days
-            candidates_df = candidates_df[candidates_df['Time_Lag_Days'] >= 0]
-            candidates_df['Abs_Lag'] = candidates_df['Time_Lag_Days'].abs()
-            candidates_df = candidates_df.sort_values(by=['Abs_Lag', 'Trade Date'])
+        # 如果有指定日期, 计算时间差（按天向下取整，与 .dt.days 一致），按 (时间差, 交易日) 排序
+        if pd.notna(desig_date):
+            lag = (cand_dates - pd.Timestamp(desig_date).value) // 86_400_000_000_000
+            keep = lag >= 0
+            cand_positions, cand_dates, cand_lags = cand_positions[keep], cand_dates[keep], lag[keep]
+            order = np.lexsort((cand_dates, cand_lags))
+            cand_lags = cand_lags[order]
         else:
-            candidates_df['Time_Lag_Days'] = np.nan
-            candidates_df = candidates_df.sort_values(by='Trade Date')
-        
-        # 分配
-        for _, ticket in candidates_df.iterrows():
-            if abs(phy_vol) < 1:
-                break
-                
-            original_index = ticket['_original_index']
-            curr_allocated = active_paper.at[original_index, 'Allocated_To_Phy']
-            curr_total_vol = ticket.get('Volume', 0)
-            avail = curr_total_vol - curr_allocated
-            
-            if abs(avail) < 0.0001:
-                continue
-                
-            alloc_amt_abs = abs(phy_vol) if abs(avail) >= abs(phy_vol) else abs(avail)
-            alloc_amt = np.sign(avail) * alloc_amt_abs
-            phy_vol -= alloc_amt_abs
-            active_paper.at[original_index, 'Allocated_To_Phy'] += alloc_amt
-            
-            # 计算 P/L 和 MTM
-            open_price = ticket.get('Price', 0)
-            mtm_price = ticket.get('Mtm Price', 0)
-            total_pl_raw = ticket.get('Total P/L', 0)
-            close_events = ticket.get('Close_Events', [])
-            close_path_str, avg_close_price, close_vol = format_close_details(close_events)
-            unrealized_mtm = (mtm_price - open_price) * alloc_amt
-            ratio = 0
-            if abs(ticket.get('Volume', 0)) > 0:
-                ratio = abs(alloc_amt) / abs(ticket['Volume'])
-            allocated_total_pl = total_pl_raw * ratio
-            
-            hedge_relations.append({
-                'Cargo_ID': cargo_id,
-                'Proxy': proxy,
-                'Designation_Date': desig_date.strftime('%Y-%m-%d') if pd.notna(desig_date) else '',
-                'Open_Date': ticket.get('Trade Date'),
-                'Time_Lag': ticket.get('Time_Lag_Days'),
-                'Ticket_ID': ticket.get('Recap No'),
-                'Month': ticket.get('Month'),
-                'Allocated_Vol': alloc_amt,
-                'Trade_Volume': ticket.get('Volume', 0),
-                'Trade_Net_Open': ticket.get('Net_Open_Vol', 0),
-                'Trade_Closed_Vol': ticket.get('Closed_Vol', 0),
-                'Open_Price': open_price,
-                'MTM_Price': mtm_price,
-                'Alloc_Unrealized_MTM': round(unrealized_mtm, 2),
-                'Alloc_Total_PL': round(allocated_total_pl, 2),
-                'Close_Path_Details': close_path_str,
-                'Close_Avg_Price': avg_close_price,
-                'Close_Volume': close_vol,
-            })
-            
-            # 更新实货未对冲量
-            orig_idx = cargo.get('_orig_idx')
-            if orig_idx in physical_df.index:
-                physical_df.at[orig_idx, 'Unhedged_Volume'] = phy_vol
-        
+            # 按 datetime64 排序：与 sort_values 走同一排序实现，同日交易的先后与原逻辑一致
+            order = np.argsort(cand_dates.view('datetime64[ns]'), kind='quicksort')
+            cand_lags = np.full(len(cand_positions), np.nan)
+        cand_chunks.append(cand_positions[order])
+        lag_chunks.append(cand_lags.astype(np.float64))
+        cand_counts[idx] = len(order)
         progress_bar.progress((idx + 1) / total_cargos)
     
-    # 将分配量写回 paper_df
-    cols_to_update = active_paper[['_original_index', 'Allocated_To_Phy']].set_index('_original_index')
-    paper_df.update(cols_to_update)
+    cand_ptr = np.concatenate(([0], np.cumsum(cand_counts)))
+    cand_flat = np.concatenate(cand_chunks) if cand_chunks else np.zeros(0, dtype=np.int64)
+    lag_flat = np.concatenate(lag_chunks) if lag_chunks else np.zeros(0)
     
-    relations_df = pd.DataFrame(hedge_relations)
+    # 第二遍：按实货顺序串行分配（同一纸货单可能被不同代理的船共享，
+    # 分配顺序决定结果，不能按桶并行），分配量和剩余量在内核里原地更新
+    rel_cargo = np.empty(len(cand_flat), dtype=np.int64)
+    rel_slot = np.empty(len(cand_flat), dtype=np.int64)
+    rel_alloc = np.empty(len(cand_flat), dtype=np.float64)
+    n_rel = _allocate_kernel(cargo_vols, cand_ptr, cand_flat, paper_vol, paper_allocated,
+                             rel_cargo, rel_slot, rel_alloc)
+    
+    # 按位置整列写回：实货按排序前的位置还原，纸货按参与匹配的掩码散回，其余记 0
+    if phy_unhedged is not None:
+        unhedged = np.empty(len(physical_df))
+        unhedged[phy_order] = phy_unhedged
+        physical_df['Unhedged_Volume'] = unhedged
+    allocated = np.zeros(len(paper_df))
+    allocated[active_mask] = paper_allocated
+    paper_df['Allocated_To_Phy'] = allocated
+    
+    # 派生列整列计算：P/L 按分配量占原始交易量的比例分摊
+    cargo_sel = rel_cargo[:n_rel]
+    pos_sel = cand_flat[rel_slot[:n_rel]]
+    alloc = rel_alloc[:n_rel]
+    rel_lag = lag_flat[rel_slot[:n_rel]]
+    if n_rel and not np.isnan(rel_lag).any():
+        rel_lag = rel_lag.astype(np.int64)
+    open_price = paper_price[pos_sel]
+    mtm_price = paper_mtm[pos_sel]
+    trade_volume = paper_volume[pos_sel].astype(np.float64)
+    trade_vol_abs = np.abs(trade_volume)
+    ratio = np.divide(np.abs(alloc), trade_vol_abs, out=np.zeros(len(alloc)), where=trade_vol_abs > 0)
+    # 平仓路径只依赖纸货单本身：同一张单分给多船时只格式化一次，再按位置展开
+    ticket_pos, ticket_inverse = np.unique(pos_sel, return_inverse=True)
+    # 所有平仓事件的日期拼成一列批量 strftime，再按单切片传入
+    ticket_events = [paper_close_events[pos] or [] for pos in ticket_pos]
+    event_date_strs = (
+        pd.DatetimeIndex([e['Date'] for events in ticket_events for e in events])
+        .strftime('%Y-%m-%d').fillna('N/A').to_numpy()
+    )
+    event_ends = np.cumsum([len(events) for events in ticket_events], dtype=np.int64)
+    close_info = [
+        format_close_details(events, event_date_strs[end - len(events):end])
+        for events, end in zip(ticket_events, event_ends)
+    ]
+    close_path = np.array([c[0] for c in close_info], dtype=object)[ticket_inverse]
+    close_avg_price = np.array([c[1] for c in close_info], dtype=np.float64)[ticket_inverse]
+    close_volume = np.array([c[2] for c in close_info], dtype=np.float64)[ticket_inverse]
+    desig_strs = (
+        df_phy['Designation_Date'].dt.strftime('%Y-%m-%d').fillna('').to_numpy()
+        if 'Designation_Date' in df_phy.columns else np.full(len(df_phy), '', dtype=object)
+    )
+    relations_df = pd.DataFrame({
+        'Cargo_ID': cargo_ids[cargo_sel],
+        'Proxy': np.array([str(p) for p in proxies], dtype=object)[cargo_sel],
+        'Designation_Date': desig_strs[cargo_sel],
+        'Open_Date': paper_trade_date[pos_sel],
+        'Time_Lag': rel_lag,
+        'Ticket_ID': paper_ticket_id[pos_sel],
+        'Month': paper_month[pos_sel],
+        'Allocated_Vol': alloc,
+        'Trade_Volume': trade_volume,
+        'Trade_Net_Open': paper_net_open[pos_sel],
+        'Trade_Closed_Vol': paper_closed[pos_sel],
+        'Open_Price': open_price,
+        'MTM_Price': mtm_price,
+        # 原逐条循环的分配量由 np.sign 得出，是 np.float64，round(x, 2) 即 NumPy 舍入；整列 np.round 与之逐位一致
+        'Alloc_Unrealized_MTM': np.round((mtm_price - open_price) * alloc, 2),
+        'Alloc_Total_PL': np.round(paper_total_pl[pos_sel] * ratio, 2),
+        'Close_Path_Details': close_path,
+        'Close_Avg_Price': close_avg_price,
+        'Close_Volume': close_volume,
+    })
     open_summary = pd.DataFrame()
     close_summary = pd.DataFrame()
     close_details = pd.DataFrame()
     if not relations_df.empty:
         open_df = relations_df[relations_df['Allocated_Vol'] > 0].copy()
         if not open_df.empty:
+            # 成交额先整列算好，按月只做一次 sum
             open_summary = (
-                open_df.groupby('Month', as_index=False)
-                .apply(lambda g: pd.Series({
-                    'Open_Volume': g['Allocated_Vol'].sum(),
-                    'Weighted_Open_Price': (
-                        (g['Allocated_Vol'] * g['Open_Price']).sum() / g['Allocated_Vol'].sum()
-                    ) if g['Allocated_Vol'].sum() else 0
-                }))
-                .reset_index(drop=True)
+                open_df.assign(_open_val=open_df['Allocated_Vol'] * open_df['Open_Price'])
+                .groupby('Month', as_index=False)
+                .agg(Open_Volume=('Allocated_Vol', 'sum'), _open_val=('_open_val', 'sum'))
             )
+            open_summary['Weighted_Open_Price'] = (
+                open_summary['_open_val'] / open_summary['Open_Volume']
+            ).where(open_summary['Open_Volume'] != 0, 0)
+            open_summary = open_summary.drop(columns='_open_val')
         close_details = relations_df[relations_df['Allocated_Vol'] < 0].sort_values(by='Open_Date')
         if not close_details.empty:
+            # 绝对量只计算一次，同时用于加权和分母
+            close_abs = close_details['Allocated_Vol'].abs()
             close_summary = (
-                close_details.groupby('Month', as_index=False)
-                .apply(lambda g: pd.Series({
-                    'Close_Volume': g['Allocated_Vol'].sum(),
-                    'Weighted_Close_Price': (
-                        (g['Allocated_Vol'].abs() * g['Close_Avg_Price']).sum() /
-                        g['Allocated_Vol'].abs().sum()
-                    ) if g['Allocated_Vol'].abs().sum() else 0
-                }))
-                .reset_index(drop=True)
+                close_details.assign(_abs_vol=close_abs, _close_val=close_abs * close_details['Close_Avg_Price'])
+                .groupby('Month', as_index=False)
+                .agg(
+                    Close_Volume=('Allocated_Vol', 'sum'),
+                    _abs_vol=('_abs_vol', 'sum'),
+                    _close_val=('_close_val', 'sum'),
+                )
             )
+            close_summary['Weighted_Close_Price'] = (
+                close_summary['_close_val'] / close_summary['_abs_vol']
+            ).where(close_summary['_abs_vol'] != 0, 0)
+            close_summary = close_summary.drop(columns=['_abs_vol', '_close_val'])
 
     return relations_df, physical_df, open_summary, close_details, close_summary
 
 # ---------------------------------------------------------
-# 4. Streamlit 主应用
+# 4. 分析图表 (按输入数据缓存 Figure，相同结果重跑时不再重建)
+# ---------------------------------------------------------
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_cargo_volume_chart(relations):
+    """各 Cargo_ID 匹配量柱状图（先取绝对值再聚合，避免逐组 lambda）。"""
+    cargo_summary = (
+        relations.assign(Allocated_Vol=relations['Allocated_Vol'].abs())
+        .groupby('Cargo_ID', observed=True, sort=False, as_index=False)['Allocated_Vol']
+        .sum()
+    )
+    return px.bar(cargo_summary, x='Cargo_ID', y='Allocated_Vol',
+                  title='各Cargo_ID匹配量',
+                  labels={'Allocated_Vol': '匹配量', 'Cargo_ID': 'Cargo ID'},
+                  color_discrete_sequence=['#4e73df'])
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_pl_histogram(relations):
+    """P/L 分布直方图。"""
+    return px.histogram(relations, x='Alloc_Total_PL',
+                        title='P/L分布直方图',
+                        labels={'Alloc_Total_PL': 'P/L值'})
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_time_lag_histogram(time_lag_data):
+    """匹配时间差分布直方图。"""
+    return px.histogram(time_lag_data,
+                        title='匹配时间差分布',
+                        labels={'value': '时间差(天)'})
+
+# ---------------------------------------------------------
+# 5. Streamlit 主应用
 # ---------------------------------------------------------
 
 def main():
@@ -374,174 +548,132 @@ def main():
     
     if paper_file is not None and physical_file is not None:
         try:
-            # 读取数据
+            # 读取并预处理数据（按文件内容缓存，重跑时不再重新解析）
             with st.spinner("正在读取数据..."):
-                # 读取纸货数据
-                if paper_file.name.endswith(('.xlsx', '.xls')):
-                    df_paper = pd.read_excel(paper_file)
-                else:
-                    df_paper = pd.read_csv(paper_file)
-                
-                # 读取实货数据
-                if physical_file.name.endswith(('.xlsx', '.xls')):
-                    df_physical = pd.read_excel(physical_file)
-                else:
-                    df_physical = pd.read_csv(physical_file)
+                paper_bytes = paper_file.getvalue()
+                physical_bytes = physical_file.getvalue()
+                paper_preview, physical_preview, df_paper, df_physical = load_uploaded_data(
+                    paper_bytes, paper_file.name, physical_bytes, physical_file.name
+                )
             
             # 显示数据预览
             col1, col2 = st.columns(2)
             with col1:
                 st.subheader("📄 纸货数据预览")
                 st.write(f"记录数: {len(df_paper)}")
-                st.dataframe(df_paper.head(), use_container_width=True)
+                st.dataframe(paper_preview, use_container_width=True)
             
             with col2:
                 st.subheader("📦 实货数据预览")
                 st.write(f"记录数: {len(df_physical)}")
-                st.dataframe(df_physical.head(), use_container_width=True)
-            
-            # 数据处理
-            with st.spinner("正在处理数据..."):
-                # 纸货数据预处理
-                if 'Trade Date' in df_paper.columns:
-                    df_paper['Trade Date'] = pd.to_datetime(df_paper['Trade Date'])
-                if 'Volume' in df_paper.columns:
-                    df_paper['Volume'] = pd.to_numeric(df_paper['Volume'], errors='coerce').fillna(0)
-                if 'Commodity' in df_paper.columns:
-                    df_paper['Std_Commodity'] = clean_str(df_paper['Commodity'])
-                if 'Month' in df_paper.columns:
-                    df_paper['Month'] = standardize_month_vectorized(df_paper['Month'])
-                if 'Recap No' not in df_paper.columns:
-                    df_paper['Recap No'] = df_paper.index.astype(str)
-                
-                # 实货数据预处理
-                col_map = {'Target_Pricing_Month': 'Target_Contract_Month', 'Month': 'Target_Contract_Month'}
-                df_physical.rename(columns=col_map, inplace=True)
-                if 'Volume' in df_physical.columns:
-                    df_physical['Volume'] = pd.to_numeric(df_physical['Volume'], errors='coerce').fillna(0)
-                    df_physical['Unhedged_Volume'] = df_physical['Volume']
-                if 'Hedge_Proxy' in df_physical.columns:
-                    df_physical['Hedge_Proxy'] = clean_str(df_physical['Hedge_Proxy'])
-                if 'Target_Contract_Month' in df_physical.columns:
-                    df_physical['Target_Contract_Month'] = standardize_month_vectorized(df_physical['Target_Contract_Month'])
-                
-                # 指定日期处理
-                if 'Designation_Date' in df_physical.columns:
-                    df_physical['Designation_Date'] = pd.to_datetime(df_physical['Designation_Date'], errors='coerce')
-                elif 'Pricing_Start' in df_physical.columns:
-                    df_physical['Designation_Date'] = pd.to_datetime(df_physical['Pricing_Start'], errors='coerce')
-                else:
-                    df_physical['Designation_Date'] = pd.NaT
+                st.dataframe(physical_preview, use_container_width=True)
             
-            # 执行匹配
+            # 执行匹配：结果存入 session_state，切换选项等重跑时直接复用
+            data_key = (paper_file.name, hash(paper_bytes), physical_file.name, hash(physical_bytes))
             if st.button("🚀 开始套保匹配", type="primary"):
                 with st.spinner("正在执行套保匹配..."):
                     # 1. 纸货内部对冲
                     df_paper_net = calculate_net_positions_corrected(df_paper)
                     
                     # 2. 实货匹配
-                    (
-                        df_relations,
-                        df_physical_updated,
-                        open_summary,
-                        close_details,
-                        close_summary,
-                    ) = auto_match_hedges(df_physical, df_paper_net)
-                    
-                    # 显示结果
-                    st.subheader("📊 匹配结果概览")
-                    
-                    col1, col2, col3 = st.columns(3)
-                    with col1:
-                        total_matched = df_relations['Allocated_Vol'].abs().sum()
-                        total_physical = df_physical['Volume'].abs().sum()
-                        match_rate = (total_matched / total_physical * 100) if total_physical > 0 else 0
-                        st.metric("匹配率", f"{match_rate:.1f}%")
-                    
-                    with col2:
-                        st.metric("匹配交易数", len(df_relations))
-                    
-                    with col3:
-                        total_pl = df_relations['Alloc_Total_PL'].sum()
-                        st.metric("总P/L", f"${total_pl:,.2f}")
-                    
-                    # 显示匹配明细
-                    st.subheader("📋 匹配明细")
-                    st.dataframe(df_relations, use_container_width=True)
+                    match_results = auto_match_hedges(df_physical, df_paper_net)
+                st.session_state['match_results'] = (data_key, df_paper_net, match_results)
+            
+            saved = st.session_state.get('match_results')
+            if saved is not None and saved[0] == data_key:
+                _, df_paper_net, match_results = saved
+                (
+                    df_relations,
+                    df_physical_updated,
+                    open_summary,
+                    close_details,
+                    close_summary,
+                ) = match_results
+                
+                # 显示结果
+                st.subheader("📊 匹配结果概览")
+                
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    total_matched = df_relations['Allocated_Vol'].abs().sum()
+                    # Volume 可能已压缩为 float32，汇总前转回 float64，避免大账簿累加误差
+                    total_physical = df_physical['Volume'].astype(np.float64).abs().sum()
+                    match_rate = (total_matched / total_physical * 100) if total_physical > 0 else 0
+                    st.metric("匹配率", f"{match_rate:.1f}%")
+                
+                with col2:
+                    st.metric("匹配交易数", len(df_relations))
+                
+                with col3:
+                    total_pl = df_relations['Alloc_Total_PL'].sum()
+                    st.metric("总P/L", f"${total_pl:,.2f}")
+                
+                # 显示匹配明细
+                st.subheader("📋 匹配明细")
+                st.dataframe(df_relations, use_container_width=True)
 
-                    # 开仓/平仓汇总
-                    st.subheader("📌 开仓与平仓汇总")
-                    col_open, col_close = st.columns(2)
-                    with col_open:
-                        st.markdown("**开仓汇总（按合约月）**")
-                        if open_summary is not None and not open_summary.empty:
-                            st.dataframe(open_summary, use_container_width=True)
-                        else:
-                            st.info("暂无开仓汇总数据。")
-                    with col_close:
-                        st.markdown("**平仓汇总（按合约月）**")
-                        if close_summary is not None and not close_summary.empty:
-                            st.dataframe(close_summary, use_container_width=True)
-                        else:
-                            st.info("暂无平仓汇总数据。")
+                # 开仓/平仓汇总
+                st.subheader("📌 开仓与平仓汇总")
+                col_open, col_close = st.columns(2)
+                with col_open:
+                    st.markdown("**开仓汇总（按合约月）**")
+                    if open_summary is not None and not open_summary.empty:
+                        st.dataframe(open_summary, use_container_width=True)
+                    else:
+                        st.info("暂无开仓汇总数据。")
+                with col_close:
+                    st.markdown("**平仓汇总（按合约月）**")
+                    if close_summary is not None and not close_summary.empty:
+                        st.dataframe(close_summary, use_container_width=True)
+                    else:
+                        st.info("暂无平仓汇总数据。")
 
-                    if close_details is not None and not close_details.empty:
-                        st.markdown("**平仓明细（按时间顺序）**")
-                        st.dataframe(close_details, use_container_width=True)
-                    
-                    # 分析图表
-                    if show_analysis and not df_relations.empty:
-                        st.subheader("📈 分析图表")
-                        
-                        tab1, tab2, tab3 = st.tabs(["匹配量分布", "P/L分布", "时间差分析"])
-                        
-                        with tab1:
-                            # 按Cargo_ID的匹配量
-                            cargo_summary = df_relations.groupby('Cargo_ID', as_index=False).agg(
-                                Allocated_Vol=('Allocated_Vol', lambda series: series.abs().sum())
-                            )
-                            fig1 = px.bar(cargo_summary, x='Cargo_ID', y='Allocated_Vol',
-                                         title='各Cargo_ID匹配量',
-                                         labels={'Allocated_Vol': '匹配量', 'Cargo_ID': 'Cargo ID'})
-                            st.plotly_chart(fig1, use_container_width=True)
-                        
-                        with tab2:
-                            # P/L分布
-                            fig2 = px.histogram(df_relations, x='Alloc_Total_PL',
-                                               title='P/L分布直方图',
-                                               labels={'Alloc_Total_PL': 'P/L值'})
-                            st.plotly_chart(fig2, use_container_width=True)
-                        
-                        with tab3:
-                            # 时间差分析
-                            if 'Time_Lag' in df_relations.columns:
-                                time_lag_data = df_relations['Time_Lag'].dropna()
-                                if not time_lag_data.empty:
-                                    fig3 = px.histogram(time_lag_data,
-                                                       title='匹配时间差分布',
-                                                       labels={'value': '时间差(天)'})
-                                    st.plotly_chart(fig3, use_container_width=True)
+                if close_details is not None and not close_details.empty:
+                    st.markdown("**平仓明细（按时间顺序）**")
+                    st.dataframe(close_details, use_container_width=True)
+                
+                # 分析图表
+                if show_analysis and not df_relations.empty:
+                    st.subheader("📈 分析图表")
                     
-                    # 下载结果
-                    st.subheader("💾 下载结果")
-                    csv = df_relations.to_csv(index=False).encode('utf-8')
-                    st.download_button(
-                        label="下载匹配结果CSV",
-                        data=csv,
-                        file_name="hedge_matching_results.csv",
-                        mime="text/csv"
-                    )
+                    tab1, tab2, tab3 = st.tabs(["匹配量分布", "P/L分布", "时间差分析"])
                     
-                    # 显示原始数据（如果选择）
-                    if show_raw_data:
-                        with st.expander("查看处理后数据"):
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.write("纸货数据（处理后）")
-                                st.dataframe(df_paper_net.head(20), use_container_width=True)
-                            with col2:
-                                st.write("实货数据（更新后）")
-                                st.dataframe(df_physical_updated.head(20), use_container_width=True)
+                    with tab1:
+                        fig1 = build_cargo_volume_chart(df_relations[['Cargo_ID', 'Allocated_Vol']])
+                        st.plotly_chart(fig1, use_container_width=True)
+
+                    with tab2:
+                        fig2 = build_pl_histogram(df_relations[['Alloc_Total_PL']])
+                        st.plotly_chart(fig2, use_container_width=True)
+
+                    with tab3:
+                        # 时间差分析
+                        if 'Time_Lag' in df_relations.columns:
+                            time_lag_data = df_relations['Time_Lag'].dropna()
+                            if not time_lag_data.empty:
+                                fig3 = build_time_lag_histogram(time_lag_data)
+                                st.plotly_chart(fig3, use_container_width=True)
+                
+                # 下载结果
+                st.subheader("💾 下载结果")
+                csv = df_relations.to_csv(index=False).encode('utf-8')
+                st.download_button(
+                    label="下载匹配结果CSV",
+                    data=csv,
+                    file_name="hedge_matching_results.csv",
+                    mime="text/csv"
+                )
+                
+                # 显示原始数据（如果选择）
+                if show_raw_data:
+                    with st.expander("查看处理后数据"):
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            st.write("纸货数据（处理后）")
+                            st.dataframe(df_paper_net.head(20), use_container_width=True)
+                        with col2:
+                            st.write("实货数据（更新后）")
+                            st.dataframe(df_physical_updated.head(20), use_container_width=True)
         
         except Exception as e:
             st.error(f"处理过程中出现错误: {str(e)}")
@@ -1,28 +1,100 @@
 import pandas as pd
 import numpy as np
+import codecs
+import importlib.util
 import os
 import time
 import warnings
 from datetime import datetime
-from collections import deque
+
+try:
+    from numba import njit
+except ImportError:  # 未安装 numba 时退回纯 Python 执行同一内核
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# 品种、月份等字符串列用 Arrow 连续缓冲存放，清洗与分组走 Arrow 计算内核；未安装 pyarrow 时用 object
+_STRING_DTYPE = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') else object
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# 数量容差：绝对值小于 EPS 视为 0；剩余未对冲量小于 MIN_ALLOC 时不再分配
+EPS = 0.0001
+MIN_ALLOC = 1.0
+_MONTH_SEPARATORS = str.maketrans('-/', '  ')
+
 # ==============================================================================
 # 1. 基础工具 (Utils)
 # ==============================================================================
 
 def clean_str(series):
     """字符串清洗：去空、转大写"""
-    return series.astype(str).str.strip().str.upper().replace('NAN', '')
+    return series.astype(str).astype(_STRING_DTYPE).str.strip().str.upper().replace('NAN', '')
+
+def downcast_float(series):
+    """数值列压缩为 float32；只有 float32 往返后逐值不变时才压缩，否则保持 float64。"""
+    values = series.to_numpy(dtype=np.float64)
+    if np.nanmax(np.abs(values), initial=0) > np.finfo(np.float32).max:
+        return series
+    compact = values.astype(np.float32)
+    if not np.array_equal(compact.astype(np.float64), values, equal_nan=True):
+        return series
+    return pd.Series(compact, index=series.index, name=series.name)
 
 def standardize_month_vectorized(series):
     """批量标准化月份格式"""
-    s = series.astype(str).str.strip().str.upper()
+    # 已是日期类型（如 Excel 日期单元格）时直接格式化，不走字符串往返；空值与字符串路径一致保留为 'NAT'
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.dt.strftime('%b %y').str.upper().fillna('NAT').astype(_STRING_DTYPE)
+    # 月份列重复值很多：按字符串取值去重，只清洗、解析去重后的取值，再按编码展开
+    codes, uniques = pd.factorize(np.array([str(x) for x in series.to_numpy()], dtype=object))
+    s = pd.Series([x.strip().upper() for x in uniques], dtype=object)
     s = s.replace('NAN', '')
-    s = s.str.replace('-', ' ', regex=False).str.replace('/', ' ', regex=False)
+    s = pd.Series([x.translate(_MONTH_SEPARATORS) for x in s], dtype=object)
     dates = pd.to_datetime(s, errors='coerce')
-    return dates.dt.strftime('%b %y').str.upper().fillna(s)
+    standardized = dates.dt.strftime('%b %y').str.upper().fillna(s).to_numpy()
+    return pd.Series(standardized[codes], index=series.index, name=series.name, dtype=_STRING_DTYPE)
+
+def sniff_encoding(file_path, sample_size=65536):
+    """
+    读取文件头部判断编码：先看 BOM，再用样本试解码，避免整文件反复解析。
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(sample_size)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    for enc in ['utf-8', 'gbk', 'gb18030']:
+        try:
+            # 增量解码器容忍样本末尾被截断的多字节字符
+            codecs.getincrementaldecoder(enc)().decode(sample, final=False)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    return 'latin1'
+
+def read_csv_fast(file_path, encoding):
+    """优先用 pyarrow 多线程解析 CSV，未安装或解析失败时退回 pandas 默认引擎。"""
+    try:
+        df = pd.read_csv(file_path, encoding=encoding, engine='pyarrow')
+    except (ImportError, ValueError):
+        # pyarrow 不接受列数不齐的行（默认引擎补 NaN），解析报错时交给默认引擎，
+        # 编码确实不对时默认引擎同样会抛错，由调用方换编码重试
+        return pd.read_csv(file_path, encoding=encoding)
+    # pyarrow 引擎的字符串空值是 None，统一为 NaN，与默认引擎一致
+    obj_cols = df.columns[df.dtypes == object]
+    df[obj_cols] = df[obj_cols].fillna(np.nan)
+    return df
+
+def read_excel_fast(file_path):
+    """优先用 calamine (Rust) 引擎解析 Excel，未安装或 pandas 不支持时退回默认引擎。"""
+    try:
+        return pd.read_excel(file_path, engine='calamine')
+    except (ImportError, ValueError):
+        return pd.read_excel(file_path)
 
 def read_file_fast(file_path):
     """
@@ -42,15 +114,21 @@ def read_file_fast(file_path):
     # 先尝试读取 Excel
     if file_path.lower().endswith(('.xlsx', '.xls')):
         try:
-            return pd.read_excel(file_path)
+            return read_excel_fast(file_path)
         except Exception:
             pass
             
-    # 尝试不同编码读取 CSV
+    # 先按嗅探出的编码只解析一次
+    try:
+        return read_csv_fast(file_path, sniff_encoding(file_path))
+    except Exception:
+        pass
+            
+    # 样本之后才出现非法字节时，再尝试不同编码读取 CSV
     encodings = ['utf-8', 'utf-8-sig', 'gbk', 'gb18030', 'latin1']
     for enc in encodings:
         try:
-            return pd.read_csv(file_path, encoding=enc)
+            return read_csv_fast(file_path, enc)
         except Exception:
             continue
             
@@ -73,7 +151,7 @@ def load_data_v19(paper_file, phys_file):
 
     # --- 纸货清洗 ---
     df_p['Trade Date'] = pd.to_datetime(df_p['Trade Date'], errors='coerce')
-    df_p['Volume'] = pd.to_numeric(df_p['Volume'], errors='coerce').fillna(0)
+    df_p['Volume'] = downcast_float(pd.to_numeric(df_p['Volume'], errors='coerce').fillna(0))
     df_p['Std_Commodity'] = clean_str(df_p['Commodity'])
     
     if 'Month' in df_p.columns:
@@ -94,10 +172,11 @@ def load_data_v19(paper_file, phys_file):
         'Target Pricing Month': 'Target_Contract_Month', 
         'Month': 'Target_Contract_Month'
     }
-    df_ph.rename(columns=col_map, inplace=True)
+    df_ph = df_ph.rename(columns=col_map)
     
-    df_ph['Volume'] = pd.to_numeric(df_ph['Volume'], errors='coerce').fillna(0)
-    df_ph['Unhedged_Volume'] = df_ph['Volume']
+    df_ph['Volume'] = downcast_float(pd.to_numeric(df_ph['Volume'], errors='coerce').fillna(0))
+    # 剩余量在匹配中逐步扣减，保持 float64
+    df_ph['Unhedged_Volume'] = df_ph['Volume'].astype(np.float64)
     df_ph['Hedge_Proxy'] = clean_str(df_ph['Hedge_Proxy']) if 'Hedge_Proxy' in df_ph.columns else ''
     df_ph['Pricing_Benchmark'] = clean_str(df_ph['Pricing_Benchmark'])
     
@@ -118,75 +197,124 @@ def load_data_v19(paper_file, phys_file):
 # 3. 计算逻辑 (v19 Logic)
 # ==============================================================================
 
+def factorize_groups(df_paper):
+    """品种、合约月分别编码后合成整数组号；Group_Key 字符串只对去重后的组拼接一次，由调用方按组号 take 展开。"""
+    comm_codes, comm_uniques = pd.factorize(df_paper['Std_Commodity'], use_na_sentinel=False)
+    month_codes, month_uniques = pd.factorize(df_paper['Month'], use_na_sentinel=False)
+    n_months = max(len(month_uniques), 1)
+    group_codes, pair_uniques = pd.factorize(comm_codes.astype(np.int64) * n_months + month_codes)
+    labels = (
+        pd.Index(comm_uniques, dtype=object).take(pair_uniques // n_months) + "_"
+        + pd.Index(month_uniques, dtype=object).take(pair_uniques % n_months)
+    )
+    return group_codes, labels
+
+@njit(cache=True)
+def fifo_net_kernel(vols, order, group_starts, net_open_vol, closed_vol,
+                    event_opener, event_closer, event_vol):
+    """按组 FIFO 抵消；各组只写自己的行和自己的事件槽位 [start, end)。"""
+    # 按组串行：引擎在 Streamlit 的脚本线程里运行，numba 并行线程层在非主线程下会卡住退出
+    for g in range(len(group_starts) - 1):
+        start = group_starts[g]
+        end = group_starts[g + 1]
+        # 队列用定长数组 + 头尾指针代替 deque
+        queue_idx = np.empty(end - start, dtype=np.int64)
+        queue_vol = np.empty(end - start, dtype=np.float64)
+        head = 0
+        tail = 0
+        n_events = start
+        for pos in range(start, end):
+            idx = order[pos]
+            current_vol = vols[idx]
+            if abs(current_vol) < EPS:
+                continue
+            current_sign = 1 if current_vol > 0 else -1
+            # 队列内同组未平仓单方向一致，方向相反才能抵消
+            while head < tail and (queue_vol[head] > 0) != (current_sign > 0):
+                q_idx = queue_idx[head]
+                q_vol = queue_vol[head]
+                q_sign = 1 if q_vol > 0 else -1
+                offset = min(abs(current_vol), abs(q_vol))
+                
+                # 记录平仓事件
+                event_opener[n_events] = q_idx
+                event_closer[n_events] = idx
+                event_vol[n_events] = offset
+                n_events += 1
+                
+                # 净额抵消 (减法)
+                current_vol -= (current_sign * offset)
+                q_vol -= (q_sign * offset)
+                
+                closed_vol[q_idx] += offset
+                net_open_vol[q_idx] = q_vol
+                closed_vol[idx] += offset
+                net_open_vol[idx] = current_vol
+                
+                if abs(q_vol) < EPS:
+                    head += 1
+                else:
+                    queue_vol[head] = q_vol
+                if abs(current_vol) < EPS:
+                    break
+            
+            if abs(current_vol) > EPS:
+                queue_idx[tail] = idx
+                queue_vol[tail] = current_vol
+                tail += 1
+
 def calculate_net_positions_corrected(df_paper):
     """Step 1: 纸货内部 FIFO 净仓计算"""
     # 确保按时间排序
     df_paper = df_paper.sort_values(by='Trade Date').reset_index(drop=True)
-    df_paper['Group_Key'] = df_paper['Std_Commodity'] + "_" + df_paper['Month']
+    group_codes, group_labels = factorize_groups(df_paper)
+    df_paper['Group_Key'] = pd.array(group_labels, dtype=_STRING_DTYPE).take(group_codes)
     
-    records = df_paper.to_dict('records')
-    groups = {}
-    for i, row in enumerate(records):
-        key = row['Group_Key']
-        if key not in groups: groups[key] = []
-        groups[key].append(i)
+    # 只取 FIFO 需要的列为数组，不再逐行转字典
+    n_rows = len(df_paper)
+    vols = df_paper['Volume'].to_numpy(dtype=np.float64)
+    # 按组号稳定排序，每组是 order 上的一段连续切片（组内保持时间顺序）
+    order = np.argsort(group_codes, kind='stable').astype(np.int64)
+    group_starts = np.concatenate(
+        ([0], np.flatnonzero(np.diff(group_codes[order])) + 1, [n_rows])
+    ).astype(np.int64)
     
-    for key, indices in groups.items():
-        open_queue = deque()
-        for idx in indices:
-            row = records[idx]
-            current_vol = row.get('Volume', 0)
-            
-            # 初始化关键字段
-            records[idx]['Net_Open_Vol'] = current_vol
-            records[idx]['Closed_Vol'] = 0
-            records[idx]['Close_Events'] = [] 
-            
-            if abs(current_vol) < 0.0001: continue
-            current_sign = 1 if current_vol > 0 else -1
-            
-            while open_queue:
-                q_idx, q_vol, q_sign = open_queue[0]
-                if q_sign != current_sign:
-                    offset = min(abs(current_vol), abs(q_vol))
-                    
-                    # 记录平仓事件
-                    close_event = {
-                        'Ref': str(records[idx].get('Recap No', '')),
-                        'Date': records[idx].get('Trade Date'),
-                        'Vol': offset,
-                        'Price': records[idx].get('Price', 0)
-                    }
-                    records[q_idx]['Close_Events'].append(close_event)
-                    
-                    # 净额抵消 (减法)
-                    current_vol -= (current_sign * offset)
-                    q_vol -= (q_sign * offset)
-                    
-                    records[q_idx]['Closed_Vol'] += offset
-                    records[q_idx]['Net_Open_Vol'] = q_vol
-                    records[idx]['Closed_Vol'] += offset
-                    records[idx]['Net_Open_Vol'] = current_vol
-                    
-                    if abs(q_vol) < 0.0001: open_queue.popleft()
-                    else: open_queue[0] = (q_idx, q_vol, q_sign)
-                    
-                    if abs(current_vol) < 0.0001: break
-                else:
-                    break
-            
-            if abs(current_vol) > 0.0001:
-                open_queue.append((idx, current_vol, current_sign))
-                
-    return pd.DataFrame(records)
+    net_open_vol = vols.copy()
+    closed_vol = np.zeros(n_rows)
+    # 平仓事件 (开仓行, 平仓行, 抵消量)：每次抵消至少了结一笔交易，
+    # 每组事件数不超过组内行数，因此每组直接占用与自身行位置相同的槽位
+    event_opener = np.full(n_rows, -1, dtype=np.int64)
+    event_closer = np.empty(n_rows, dtype=np.int64)
+    event_vol = np.empty(n_rows, dtype=np.float64)
+    fifo_net_kernel(vols, order, group_starts, net_open_vol, closed_vol,
+                    event_opener, event_closer, event_vol)
+    used = np.flatnonzero(event_opener >= 0)
+    # 事件按平仓日期稳定排序后再写入，每单的 Close_Events 天然按时间排列（空日期在前）
+    date_keys = df_paper['Trade Date'].to_numpy('datetime64[ns]').view('int64')
+    used = used[np.argsort(date_keys[event_closer[used]], kind='stable')]
+    
+    # 平仓明细只在最后按事件还原一次
+    recaps = df_paper['Recap No'].to_numpy(dtype=object)
+    trade_dates = df_paper['Trade Date'].array
+    prices = df_paper['Price'].to_numpy()
+    close_events = [[] for _ in range(n_rows)]
+    for q_idx, idx, offset in zip(event_opener[used], event_closer[used], event_vol[used]):
+        close_events[q_idx].append({
+            'Ref': str(recaps[idx]),
+            'Date': trade_dates[idx],
+            'Vol': offset,
+            'Price': prices[idx]
+        })
+    
+    return df_paper.assign(Net_Open_Vol=net_open_vol, Closed_Vol=closed_vol, Close_Events=close_events)
 
 def format_close_details(events):
     if not events: return "", 0, 0
+    # Close_Events 在 Step 1 写入时已按日期排好序
     details = []
     total_vol = 0
     total_val = 0
-    sorted_events = sorted(events, key=lambda x: x['Date'] if pd.notna(x['Date']) else pd.Timestamp.min)
-    for e in sorted_events:
+    for e in events:
         d_str = e['Date'].strftime('%Y-%m-%d') if pd.notna(e['Date']) else 'N/A'
         p_str = f"@{e['Price']}" if pd.notna(e['Price']) else ""
         details.append(f"[{d_str} #{e['Ref']} V:{e['Vol']:.0f} {p_str}]")
@@ -217,78 +345,141 @@ def _contract_month_priority(month_value):
     priority = priority_order.index(key) if key in priority_order else 999
     return priority, parsed
 
+def _contract_month_priorities(months):
+    """合约月优先级与日期：只对去重后的月份解析一次，再按编码展开回每行。"""
+    codes, uniques = pd.factorize(months, use_na_sentinel=False)
+    parsed = [_contract_month_priority(m) for m in uniques]
+    priorities = np.array([p for p, _ in parsed], dtype=np.int64)
+    dates = pd.DatetimeIndex([d for _, d in parsed])
+    return (
+        pd.Series(priorities[codes], index=months.index),
+        pd.Series(dates.take(codes), index=months.index),
+    )
+
+def column_values(df, column, default):
+    """整列取成数组；列不存在时按 Series.get 的缺省语义返回默认值数组。"""
+    if column in df.columns:
+        return df[column].to_numpy()
+    return np.full(len(df), default, dtype=object)
+
 def auto_match_hedges(physical_df, paper_df):
     """Step 2: 实货匹配 (v19 开放式逻辑 + 优先排序)"""
-    hedge_relations = []
-    
-    # 强制初始化 Allocated_To_Phy (防止 KeyError)
-    if 'Allocated_To_Phy' not in paper_df.columns:
-        paper_df['Allocated_To_Phy'] = 0.0
-    
     match_start = _match_start_date(paper_df)
-    # 索引构建 (只取有净敞口且在指定日之后的单子)
-    active_paper = paper_df[
-        (abs(paper_df['Net_Open_Vol']) > 0.0001) &
-        (paper_df['Trade Date'] >= match_start)
-    ].copy()
-    active_paper['Allocated_To_Phy'] = 0.0
-    active_paper['_original_index'] = active_paper.index
+    # 索引构建 (只取有净敞口且在指定日之后的单子)：两个条件在数组上一次算出掩码，空日期比较结果为 False
+    active_mask = (
+        (np.abs(paper_df['Net_Open_Vol'].to_numpy(dtype=np.float64)) > EPS) &
+        (paper_df['Trade Date'].to_numpy('datetime64[ns]') >= np.datetime64(match_start, 'ns'))
+    )
+    active_paper = paper_df.iloc[np.flatnonzero(active_mask)]
+    # 余额按位置放在数组里读写，循环内不再走 .at 标签查找
+    net_arr = active_paper['Net_Open_Vol'].to_numpy(dtype=np.float64)
+    alloc_arr = np.zeros(len(active_paper))
+    # (品种, 合约月, 净敞口方向) → 行位置的索引，循环外只建一次；
+    # 代理按子串匹配品种，每个代理只对去重后的品种列表判断一次
+    sign_arr = np.sign(net_arr).astype(np.int64)
+    bucket_positions = active_paper.groupby(
+        [active_paper['Std_Commodity'], active_paper['Month'], sign_arr], sort=False
+    ).indices
+    paper_commodities = active_paper['Std_Commodity'].unique()
+    proxy_commodities = {}
+    # 同一 (代理, 合约月, 方向) 的候选位置只合并排序一次，之后的船直接查表
+    proxy_bucket_positions = {}
+    # 票据字段整列取出，循环内按位置读，不再逐单构造 DataFrame / dict
+    paper_price = column_values(active_paper, 'Price', 0).astype(np.float64)
+    paper_mtm = column_values(active_paper, 'Mtm Price', 0).astype(np.float64)
+    paper_total_pl = column_values(active_paper, 'Total P/L', 0).astype(np.float64)
+    paper_volume = column_values(active_paper, 'Volume', 0).astype(np.float64)
+    paper_close_events = column_values(active_paper, 'Close_Events', None)
+    paper_ticket_id = column_values(active_paper, 'Recap No', None)
+    paper_month = active_paper['Month'].to_numpy()
+    paper_trade_date = active_paper['Trade Date'].to_numpy()
+    # 交易日期转成 int64 纳秒（active_paper 已按开始日期过滤，不含空日期）
+    paper_date_ns = active_paper['Trade Date'].to_numpy('datetime64[ns]').view('int64')
+    # Step 1 的输出已按交易日期排序：此时各候选位置数组也按日期升序，
+    # 指定日之后的候选是一段后缀，且 Abs_Lag 随日期单调，无需逐船再排序
+    dates_sorted = bool(np.all(paper_date_ns[1:] >= paper_date_ns[:-1]))
 
     # 实货排序 (优先级: Pricing_Benchmark -> Contract Month -> Designation Date)
     physical_df['Sort_Date'] = physical_df['Designation_Date'].fillna(pd.Timestamp.max)
-    physical_df['Benchmark_Priority'] = physical_df['Pricing_Benchmark'].apply(
-        lambda x: 0 if 'BRENT' in str(x).upper() else (1 if 'JCC' in str(x).upper() else 2)
+    benchmarks = physical_df['Pricing_Benchmark'].astype(str).str.upper()
+    physical_df['Benchmark_Priority'] = np.select(
+        [benchmarks.str.contains('BRENT', regex=False), benchmarks.str.contains('JCC', regex=False)],
+        [0, 1], default=2
+    )
+    physical_df['Contract_Priority'], physical_df['Contract_Date'] = _contract_month_priorities(
+        physical_df['Target_Contract_Month']
     )
-    contract_priority = physical_df['Target_Contract_Month'].apply(_contract_month_priority)
-    physical_df['Contract_Priority'] = contract_priority.map(lambda x: x[0])
-    physical_df['Contract_Date'] = contract_priority.map(lambda x: x[1])
     physical_df_sorted = physical_df.sort_values(
         by=['Benchmark_Priority', 'Contract_Priority', 'Contract_Date', 'Sort_Date', 'Cargo_ID']
     )
 
-    for idx, cargo in physical_df_sorted.iterrows():
-        cargo_id = cargo['Cargo_ID']
-        phy_vol = cargo['Unhedged_Volume']
-        proxy = str(cargo['Hedge_Proxy'])
-        target_month = cargo.get('Target_Contract_Month', None)
-        phy_dir = cargo.get('Direction', 'Buy')
-        desig_date = cargo.get('Designation_Date', pd.NaT)
+    # 实货字段循环外整列取出，循环内按位置取值，不再逐行构造 Series；
+    # 剩余量写进数组，循环结束后整列回写一次
+    # 匹配关系按列缓存 (实货, 纸货位置, 分配量, 时间差)，其余字段循环后整列派生
+    rel_cargo, rel_pos, rel_alloc, rel_lag = [], [], [], []
+    cargo_ids = physical_df_sorted['Cargo_ID'].tolist()
+    unhedged = physical_df_sorted['Unhedged_Volume'].to_numpy(dtype=np.float64, copy=True)
+    proxies = physical_df_sorted['Hedge_Proxy'].tolist()
+    target_months = column_values(physical_df_sorted, 'Target_Contract_Month', None)
+    phy_dirs = column_values(physical_df_sorted, 'Direction', 'Buy')
+    desig_dates = (
+        physical_df_sorted['Designation_Date'].array
+        if 'Designation_Date' in physical_df_sorted.columns else [pd.NaT] * len(physical_df_sorted)
+    )
+    
+    for i in range(len(physical_df_sorted)):
+        cargo_id = cargo_ids[i]
+        phy_vol = unhedged[i]
+        proxy = str(proxies[i])
+        target_month = target_months[i]
+        phy_dir = phy_dirs[i]
+        desig_date = desig_dates[i]
         
         required_open_sign = -1 if 'BUY' in str(phy_dir).upper() else 1
         
         # 筛选: 品种 + 月份 + 方向
-        mask = (
-            (active_paper['Std_Commodity'].str.contains(proxy, regex=False)) & 
-            (active_paper['Month'] == target_month) &
-            (np.sign(active_paper['Net_Open_Vol']) == required_open_sign)
-        )
-        candidates_df = active_paper[mask].copy()
-        
-        if candidates_df.empty: continue
+        lookup_key = (proxy, target_month, required_open_sign)
+        cand_positions = proxy_bucket_positions.get(lookup_key)
+        if cand_positions is None:
+            if proxy not in proxy_commodities:
+                proxy_commodities[proxy] = [c for c in paper_commodities if proxy in c]
+            bucket_hits = [
+                bucket_positions[(commodity, target_month, required_open_sign)]
+                for commodity in proxy_commodities[proxy]
+                if (commodity, target_month, required_open_sign) in bucket_positions
+            ]
+            cand_positions = (
+                np.sort(np.concatenate(bucket_hits)) if bucket_hits else np.zeros(0, dtype=np.int64)
+            )
+            proxy_bucket_positions[lookup_key] = cand_positions
+        if not len(cand_positions): continue
+        cand_dates = paper_date_ns[cand_positions]
         
         # 排序策略 (v19: Abs_Lag 优先)
-        if pd.notna(desig_date) and not candidates_df['Trade Date'].isnull().all():
-            candidates_df['Time_Lag_Days'] = (candidates_df['Trade Date'] - desig_date).dt.days
-            candidates_df = candidates_df[candidates_df['Time_Lag_Days'] >= 0]
-            candidates_df['Abs_Lag'] = candidates_df['Time_Lag_Days'].abs()
-            candidates_df = candidates_df.sort_values(by=['Abs_Lag', 'Trade Date'])
+        if pd.notna(desig_date) and dates_sorted:
+            desig_ns = pd.Timestamp(desig_date).value
+            start = np.searchsorted(cand_dates, desig_ns)
+            cand_positions = cand_positions[start:]
+            cand_lags = (cand_dates[start:] - desig_ns) // 86_400_000_000_000
+        elif pd.notna(desig_date):
+            lag = (cand_dates - pd.Timestamp(desig_date).value) // 86_400_000_000_000
+            keep = lag >= 0
+            cand_positions, cand_dates, cand_lags = cand_positions[keep], cand_dates[keep], lag[keep]
+            order = np.lexsort((cand_dates, cand_lags))
+            cand_positions, cand_lags = cand_positions[order], cand_lags[order]
         else:
-            candidates_df['Time_Lag_Days'] = np.nan
-            candidates_df = candidates_df.sort_values(by='Trade Date')
-            
-        candidates = candidates_df.to_dict('records')
+            # 与 sort_values(by='Trade Date') 一致：按 datetime64 快排，同日顺序不变
+            order = np.argsort(cand_dates.view('datetime64[ns]'), kind='quicksort')
+            cand_positions = cand_positions[order]
+            cand_lags = np.full(len(cand_positions), np.nan)
         
-        for ticket in candidates:
-            if abs(phy_vol) < 1: break
-            
-            orig_idx = ticket['_original_index']
+        for pos, time_lag in zip(cand_positions.tolist(), cand_lags.tolist()):
+            if abs(phy_vol) < MIN_ALLOC: break
             
             # 实时查余额
-            curr_allocated = active_paper.at[orig_idx, 'Allocated_To_Phy']
-            curr_net_open = active_paper.at[orig_idx, 'Net_Open_Vol']
-            net_avail = curr_net_open - curr_allocated
+            net_avail = net_arr[pos] - alloc_arr[pos]
             
-            if abs(net_avail) < 0.0001: continue
+            if abs(net_avail) < EPS: continue
             
             if abs(net_avail) >= abs(phy_vol):
                 alloc_amt = (1 if net_avail > 0 else -1) * abs(phy_vol)
@@ -296,46 +487,49 @@ def auto_match_hedges(physical_df, paper_df):
                 alloc_amt = net_avail
                 
             phy_vol -= (-alloc_amt)
-            active_paper.at[orig_idx, 'Allocated_To_Phy'] += alloc_amt
-            
-            # 财务数据
-            open_price = ticket.get('Price', 0)
-            mtm_price = ticket.get('Mtm Price', 0)
-            total_pl = ticket.get('Total P/L', 0)
-            close_path, close_avg_price, close_vol = format_close_details(ticket.get('Close_Events', []))
-            
-            unrealized_mtm = (mtm_price - open_price) * alloc_amt
-            ratio = 0
-            if abs(ticket.get('Volume', 0)) > 0:
-                ratio = abs(alloc_amt) / abs(ticket['Volume'])
-            alloc_total_pl = total_pl * ratio
+            alloc_arr[pos] += alloc_amt
             
-            hedge_relations.append({
-                'Cargo_ID': cargo_id,
-                'Ticket_ID': ticket.get('Recap No'),
-                'Month': ticket.get('Month'),
-                'Trade_Date': ticket.get('Trade Date'),
-                'Allocated_Vol': alloc_amt,
-                'Open_Price': open_price,
-                'MTM_PL': round(unrealized_mtm, 2),
-                'Total_PL_Alloc': round(alloc_total_pl, 2),
-                'Time_Lag': ticket.get('Time_Lag_Days'),
-                'Close_Path': close_path,
-                'Close_Avg_Price': close_avg_price,
-                'Close_Volume': close_vol
-            })
+            rel_cargo.append(cargo_id)
+            rel_pos.append(pos)
+            rel_alloc.append(alloc_amt)
+            rel_lag.append(time_lag)
             
-        physical_df_sorted.at[idx, 'Unhedged_Volume'] = phy_vol
+        unhedged[i] = phy_vol
+        
+    physical_df_sorted['Unhedged_Volume'] = unhedged
+    
+    # --- 财务数据：整列计算，P/L 按分配量占原始交易量的比例分摊 ---
+    # P/L 每行都用 np.round 保留两位小数（放大 100 倍后四舍六入五成双），与 app.py 一致
+    rel_pos = np.array(rel_pos, dtype=np.int64)
+    rel_alloc = np.array(rel_alloc, dtype=np.float64)
+    open_price = paper_price[rel_pos]
+    trade_vol_abs = np.abs(paper_volume[rel_pos])
+    ratio = np.divide(np.abs(rel_alloc), trade_vol_abs, out=np.zeros(len(rel_alloc)), where=trade_vol_abs > 0)
+    # 平仓摘要只依赖纸货单本身：同一单被多个实货分到时只格式化一次，再按编码展开
+    ticket_pos, ticket_inverse = np.unique(rel_pos, return_inverse=True)
+    close_info = [format_close_details(paper_close_events[pos]) for pos in ticket_pos]
+    hedge_relations = pd.DataFrame({
+        'Cargo_ID': rel_cargo,
+        'Ticket_ID': paper_ticket_id[rel_pos],
+        'Month': paper_month[rel_pos],
+        'Trade_Date': paper_trade_date[rel_pos],
+        'Allocated_Vol': rel_alloc,
+        'Open_Price': open_price,
+        'MTM_PL': np.round((paper_mtm[rel_pos] - open_price) * rel_alloc, 2),
+        'Total_PL_Alloc': np.round(paper_total_pl[rel_pos] * ratio, 2),
+        'Time_Lag': rel_lag,
+        'Close_Path': [close_info[k][0] for k in ticket_inverse],
+        'Close_Avg_Price': [close_info[k][1] for k in ticket_inverse],
+        'Close_Volume': [close_info[k][2] for k in ticket_inverse]
+    })
         
     # --- 回写分配量 ---
-    if not active_paper.empty:
-        # 使用 map 回写，比 update 更安全
-        alloc_map = active_paper.set_index('_original_index')['Allocated_To_Phy']
-        paper_df['Allocated_To_Phy'] = paper_df.index.map(alloc_map).fillna(0.0)
-    else:
-        paper_df['Allocated_To_Phy'] = 0.0
+    # 按掩码位置散回，未参与匹配的单子记 0
+    allocated = np.zeros(len(paper_df))
+    allocated[active_mask] = alloc_arr
+    paper_df['Allocated_To_Phy'] = allocated
         
-    return pd.DataFrame(hedge_relations), physical_df_sorted, paper_df
+    return hedge_relations, physical_df_sorted, paper_df
 
 if __name__ == "__main__":
     # 本地测试接口
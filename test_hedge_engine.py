@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+import hedge_engine
+
+
+def test_read_file_fast_fills_short_csv_rows(tmp_path):
+    path = tmp_path / "paper.csv"
+    path.write_text("a,b,c\n1,2,3\n4,5,6\n7,8,9\n10,11\n", encoding="utf-8")
+
+    df = hedge_engine.read_file_fast(str(path))
+
+    assert len(df) == 4
+    assert df.loc[3, 'a'] == 10
+    assert np.isnan(df.loc[3, 'c'])
+
+
+def _paper_row(recap, month, total_pl):
+    return {
+        'Trade Date': pd.Timestamp('2025-11-20'), 'Volume': -1.0, 'Std_Commodity': 'BRENT', 'Month': month,
+        'Recap No': recap, 'Price': 70.0, 'Mtm Price': 70.0, 'Total P/L': total_pl,
+    }
+
+
+def _cargo_row(cargo_id, volume, month):
+    return {
+        'Cargo_ID': cargo_id, 'Volume': volume, 'Unhedged_Volume': volume, 'Hedge_Proxy': 'BRENT',
+        'Pricing_Benchmark': 'BRENT', 'Target_Contract_Month': month, 'Direction': 'Buy',
+        'Designation_Date': pd.Timestamp('2025-11-15'),
+    }
+
+
+def test_allocated_pl_rounds_every_row_with_np_round():
+    # 2.675 在二进制里略小于 2.675：内置 round 得 2.67，np.round 先放大 100 倍得 2.68
+    paper = pd.DataFrame([
+        _paper_row('R1', 'JAN 26', 2.675),
+        _paper_row('R2', 'FEB 26', 2.675),
+        _paper_row('R3', 'FEB 26', 2.675),
+    ])
+    physical = pd.DataFrame([
+        _cargo_row('C1', 1.0, 'JAN 26'),
+        _cargo_row('C2', 2.0, 'FEB 26'),
+    ])
+
+    paper_net = hedge_engine.calculate_net_positions_corrected(paper)
+    relations, _, _ = hedge_engine.auto_match_hedges(physical, paper_net)
+
+    # C1 按剩余量整笔分配，C2 按单子余额分配：两种路径的行舍入规则相同
+    assert relations[['Cargo_ID', 'Ticket_ID']].values.tolist() == [['C1', 'R1'], ['C2', 'R2'], ['C2', 'R3']]
+    assert relations['Total_PL_Alloc'].tolist() == [2.68, 2.68, 2.68]
+
+
+def test_close_events_are_sorted_by_date_with_nat_first():
+    rng = np.random.default_rng(0)
+    n = 400
+    trade_dates = pd.Series(pd.Timestamp('2025-01-01') + pd.to_timedelta(rng.integers(0, 60, n), unit='D'))
+    trade_dates[rng.random(n) < 0.1] = pd.NaT
+    paper = pd.DataFrame({
+        'Trade Date': trade_dates,
+        'Volume': rng.integers(-50, 50, n).astype(float),
+        'Std_Commodity': rng.choice(['BRENT', 'DUBAI'], n),
+        'Month': rng.choice(['JAN 26', 'FEB 26'], n),
+        'Recap No': [f'R{i}' for i in range(n)],
+        'Price': 70.0,
+    })
+
+    paper_net = hedge_engine.calculate_net_positions_corrected(paper)
+
+    assert sum(len(events) for events in paper_net['Close_Events']) > 0
+    for events in paper_net['Close_Events']:
+        keys = [pd.Timestamp.min if pd.isna(e['Date']) else e['Date'] for e in events]
+        assert keys == sorted(keys)
+
+
+def test_downcast_float_only_when_round_trip_is_exact():
+    whole = pd.Series([1200.0, -35.0, 0.0, np.nan])
+    fractional = pd.Series([1200.3, 0.3])
+
+    assert hedge_engine.downcast_float(whole).dtype == np.float32
+    assert hedge_engine.downcast_float(fractional).dtype == np.float64
+    assert hedge_engine.downcast_float(fractional).tolist() == [1200.3, 0.3]